@@ -1,7 +1,74 @@
 import json
-import xml.etree.ElementTree as ET
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+TOOL_NAME = "BGI_NGS_Knowledge_Build"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# Shared session so all E-utilities calls reuse keep-alive connections;
+# retries are handled by request_with_retry
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = f"{TOOL_NAME} (python-requests)"
+SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per second
+    
+    The bucket holds at most one token, so idle time never builds up a
+    burst: calls stay at least 1/rate seconds apart.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        """Block until a token is available, then take it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.updated = time.monotonic()
+                self.tokens = 1.0
+            self.tokens -= 1
+
+def request_with_retry(method, url, rate_limiter=None, retries=5, base_delay=0.5, max_delay=30, **kwargs):
+    """Send a request through SESSION, retrying only transient failures
+    
+    Rate limiting (429), server errors (5xx), timeouts and connection errors
+    are retried with decorrelated-jitter backoff; other HTTP errors are
+    raised immediately.
+    """
+    delay = base_delay
+    for attempt in range(retries):
+        if rate_limiter:
+            rate_limiter.wait()
+        try:
+            response = SESSION.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"{response.status_code} Error for url: {url}", response=response)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            error = e
+        
+        if attempt == retries - 1:
+            raise error
+        delay = min(max_delay, random.uniform(base_delay, delay * 3))
+        retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
 
 def load_config(config_file='search_config.json'):
     """Load configuration from JSON file"""
@@ -18,7 +85,7 @@ def load_config(config_file='search_config.json'):
         print(f"Error: Failed to read config file - {e}")
         return None
 
-def search_pubmed(keyword, email, api_key=None, mindate=None, maxdate=None):
+def search_pubmed(keyword, email, api_key=None, mindate=None, maxdate=None, rate_limiter=None):
     """Search PubMed for articles matching keyword and date range
     
     Args:
@@ -27,11 +94,13 @@ def search_pubmed(keyword, email, api_key=None, mindate=None, maxdate=None):
         api_key: Optional NCBI API key for higher rate limits
         mindate: Start date (YYYY/MM/DD or YYYY/MM or YYYY)
         maxdate: End date (YYYY/MM/DD or YYYY/MM or YYYY)
+        rate_limiter: Optional RateLimiter shared between concurrent searches
     """
     base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     params = {
         'db': 'pubmed',
         'term': keyword,
+        'tool': TOOL_NAME,
         'email': email,
         'retmax': 10000
     }
@@ -46,21 +115,25 @@ def search_pubmed(keyword, email, api_key=None, mindate=None, maxdate=None):
         print(f"Date range: {mindate} to {maxdate}")
     
     try:
-        response = requests.get(base_url, params=params)
-        response.raise_for_status()
+        response = request_with_retry('GET', base_url, rate_limiter, params=params, timeout=60)
         
-        root = ET.fromstring(response.text)
-        id_list = root.find('IdList')
+        root = etree.fromstring(response.content)
+        ids = [id_elem.text for id_elem in root.iterfind('IdList/Id')]
         
-        if id_list is not None:
-            ids = [id_elem.text for id_elem in id_list.findall('Id')]
+        if ids:
             print(f"Keyword '{keyword}': Found {len(ids)} PubMed IDs")
+            
+            # ESearch returns at most retmax IDs, even through the History server
+            count = int(root.findtext('Count') or 0)
+            if count > len(ids):
+                print(f"Warning: {count} articles match but only {len(ids)} IDs were returned")
+                print("Consider narrowing the date range or splitting the keyword")
             return ids
         else:
             print(f"Keyword '{keyword}': No results found")
             return []
             
-    except ET.ParseError as e:
+    except etree.XMLSyntaxError as e:
         print(f"XML parse error: {e}")
         return []
     except requests.RequestException as e:
@@ -110,20 +183,24 @@ def main():
         print(f"Warning: You have {len(keywords)} keywords, but limit is {max_keywords}")
         print(f"Consider {'adding an API key' if not api_key else 'reducing keywords'}")
     
-    # Search for all keywords
-    all_ids = []
-    for keyword in keywords:
-        print(f"\nProcessing keyword: {keyword}")
-        ids = search_pubmed(keyword, email, api_key, mindate, maxdate)
-        all_ids.extend(ids)
-    
-    # Remove duplicates and save
-    unique_ids = list(set(all_ids))
+    # Search for all keywords, deduplicating as we go
+    total_ids = 0
+    unique_ids = set()
+    rate = 10 if api_key else 3
+    rate_limiter = RateLimiter(rate)
+    print(f"\nProcessing {len(keywords)} keywords")
+    with ThreadPoolExecutor(max_workers=rate) as executor:
+        for ids in executor.map(
+            lambda keyword: search_pubmed(keyword, email, api_key, mindate, maxdate, rate_limiter),
+            keywords
+        ):
+            total_ids += len(ids)
+            unique_ids.update(ids)
     
     with open('pubmed_ids.txt', 'w') as f:
         f.write('\n'.join(unique_ids))
     
-    print(f"\nTotal IDs found: {len(all_ids)}")
+    print(f"\nTotal IDs found: {total_ids}")
     print(f"Unique IDs: {len(unique_ids)}")
     print("Results saved to pubmed_ids.txt")
 
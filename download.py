@@ -1,56 +1,204 @@
-import json
+import argparse
+import hashlib
+import pickle
+import re
+import sqlite3
 import time
+from io import BytesIO
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import requests
-import markdown
+import orjson
+from lxml import etree
 from tqdm import tqdm
-from pubmed_mapper import Article
+
+try:
+    import cmarkgfm
+except ImportError:
+    cmarkgfm = None
+    from markdown_it import MarkdownIt
+    _MARKDOWN_IT = MarkdownIt()
+
+from crawl import TOOL_NAME, RateLimiter, load_config, request_with_retry
 
 # Configuration
-MAX_WORKERS = 5
-BATCH_SIZE = 1
+MAX_WORKERS = 10
+# Batches fetched but not yet written are capped at this many
+MAX_PENDING = 2 * MAX_WORKERS
+BATCH_SIZE = 200
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
 BASE_DIR = Path(__file__).parent
 BASE_DIR.mkdir(exist_ok=True)
+CACHE_FILE = BASE_DIR / "article_cache.db"
+WRITE_BUFFER = 1 << 20
+# Code hosting mentions or "available at/from" pointers to code or data
+_LINK_RE = re.compile(r'github|gitlab|bitbucket|available\s+(?:at|from)', re.I)
+_MEDLINE_DATE_RE = re.compile(r'(\d{4})(?:\s+([A-Za-z]{3}))?')
+_MONTHS = {
+    'jan': '01', 'feb': '02', 'mar': '03', 'apr': '04', 'may': '05', 'jun': '06',
+    'jul': '07', 'aug': '08', 'sep': '09', 'oct': '10', 'nov': '11', 'dec': '12'
+}
+# Bump when parse_pubmed_article output changes to invalidate the article cache
+ARTICLE_CACHE_VERSION = 2
+# Bump when format_article_markdown or render_markdown output changes to
+# invalidate md caches
+MD_FORMAT_VERSION = 3
 
-def fetch_article_data(pmid, retries=3):
-    """Fetch article data for a single PMID with retry logic"""
-    for attempt in range(retries):
-        try:
-            article = Article.parse_pmid(pmid)
-            authors = [str([author, author.affiliation]) for author in article.authors]
-            doi = next((id_obj.id_value for id_obj in article.ids if id_obj.id_type == 'doi'), None)
-            pmc_id = next((id_obj.id_value for id_obj in article.ids if id_obj.id_type == 'pmc'), None)
-            
-            return {
-                "pub_id": pmid,
-                "doi": doi,
-                "pmc_id": pmc_id,
-                "abstract": article.abstract or "",
-                "title": article.title or "",
-                "keyword": article.keywords if hasattr(article, 'keywords') else [],
-                "first_author_affiliation": authors[0] if authors else None,
-                "communicate_author_affiliation": authors[-1] if authors else None,
-                "journal": article.journal.title if article.journal else None,
-                "pub_date": str(article.pubdate) if article.pubdate else None
-            }
-        except Exception as e:
-            if attempt < retries - 1:
-                time.sleep(3 ** attempt)
-            else:
-                print(f"Failed to process {pmid}: {str(e)}")
-                return None
-    return None
+def open_cache(cache_file=CACHE_FILE):
+    """Open the SQLite article cache, creating the table if needed"""
+    conn = sqlite3.connect(cache_file)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != ARTICLE_CACHE_VERSION:
+        conn.execute("DROP TABLE IF EXISTS articles")
+        conn.execute(f"PRAGMA user_version={ARTICLE_CACHE_VERSION}")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS articles "
+        "(pmid TEXT PRIMARY KEY, json TEXT, fetched_at INT)"
+    )
+    return conn
+
+def load_cached_articles(conn, pm_ids):
+    """Return cached article data for the given PMIDs, keyed by PMID"""
+    cached = {}
+    for pmid in pm_ids:
+        row = conn.execute("SELECT json FROM articles WHERE pmid=?", (pmid,)).fetchone()
+        if row:
+            cached[pmid] = orjson.loads(row[0])
+    return cached
+
+def save_cached_articles(conn, articles):
+    """Store fetched article data in the cache"""
+    now = int(time.time())
+    conn.executemany(
+        "INSERT OR REPLACE INTO articles (pmid, json, fetched_at) VALUES (?, ?, ?)",
+        [(pmid, orjson.dumps(data).decode('utf-8'), now) for pmid, data in articles.items()]
+    )
+    conn.commit()
+
+def parse_author(author):
+    """Extract name and affiliation from an <Author> element"""
+    name = ' '.join(filter(None, [author.findtext('ForeName'), author.findtext('LastName')]))
+    return {
+        "name": name or author.findtext('CollectiveName'),
+        "affiliation": author.findtext('AffiliationInfo/Affiliation')
+    }
+
+def parse_month(month):
+    """Convert a PubMed month ('Jan' or '1') to a zero-padded number"""
+    if not month:
+        return None
+    if month.isdigit():
+        return month.zfill(2)
+    return _MONTHS.get(month[:3].lower())
+
+def parse_pub_date(pub_date):
+    """Format a <PubDate> element as YYYY-MM-DD, YYYY-MM or YYYY"""
+    if pub_date is None:
+        return None
+    year = pub_date.findtext('Year')
+    if year:
+        month = parse_month(pub_date.findtext('Month'))
+        day = pub_date.findtext('Day')
+        parts = [year, month, day.zfill(2) if month and day else None]
+        return '-'.join(filter(None, parts))
+    
+    # MedlineDate holds free text such as "2024 Jan-Feb" or "2023 Winter"
+    medline_date = pub_date.findtext('MedlineDate')
+    match = _MEDLINE_DATE_RE.match(medline_date or '')
+    if not match:
+        return medline_date
+    month = parse_month(match.group(2))
+    return f"{match.group(1)}-{month}" if month else match.group(1)
+
+def parse_abstract(article):
+    """Join AbstractText sections, prefixing structured ones with their label"""
+    sections = []
+    for text in article.iterfind('Abstract/AbstractText'):
+        content = ''.join(text.itertext())
+        label = text.get('Label')
+        sections.append(f"{label}: {content}" if label else content)
+    return ' '.join(sections)
+
+def parse_pubmed_article(elem):
+    """Extract article data from a <PubmedArticle> element"""
+    citation = elem.find('MedlineCitation')
+    article = citation.find('Article')
+    
+    # Only the first and corresponding (last) authors are kept
+    authors = article.findall('AuthorList/Author')
+    
+    title = article.find('ArticleTitle')
+    
+    return {
+        "pub_id": citation.findtext('PMID'),
+        "doi": elem.findtext("PubmedData/ArticleIdList/ArticleId[@IdType='doi']"),
+        "pmc_id": elem.findtext("PubmedData/ArticleIdList/ArticleId[@IdType='pmc']"),
+        "abstract": parse_abstract(article),
+        "title": ''.join(title.itertext()) if title is not None else "",
+        "keyword": [''.join(k.itertext()) for k in citation.iterfind('KeywordList/Keyword')],
+        "first_author_affiliation": parse_author(authors[0]) if authors else None,
+        "communicate_author_affiliation": parse_author(authors[-1]) if authors else None,
+        "journal": article.findtext('Journal/Title'),
+        "pub_date": parse_pub_date(article.find('Journal/JournalIssue/PubDate'))
+    }
+
+def fetch_batch(batch, rate_limiter, api_key=None, email=None):
+    """Fetch a batch of PMIDs with a single EFetch request and yield article dicts"""
+    data = {
+        'db': 'pubmed',
+        'id': ','.join(batch),
+        'retmode': 'xml',
+        'tool': TOOL_NAME
+    }
+    if api_key:
+        data['api_key'] = api_key
+    if email:
+        data['email'] = email
+    
+    try:
+        response = request_with_retry('POST', EFETCH_URL, rate_limiter, data=data, timeout=60)
+    except requests.RequestException as e:
+        print(f"Failed to fetch batch starting at {batch[0]}: {str(e)}")
+        return
+    
+    # Stream one article at a time, discarding parsed ones to bound memory
+    for _, elem in etree.iterparse(BytesIO(response.content), tag='PubmedArticle'):
+        yield parse_pubmed_article(elem)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+def process_batch(batch, rate_limiter, api_key=None, email=None):
+    """Fetch a batch of PMIDs, returning article data keyed by PMID"""
+    articles = {}
+    try:
+        for article_data in fetch_batch(batch, rate_limiter, api_key, email):
+            articles[article_data["pub_id"]] = article_data
+    except etree.XMLSyntaxError as e:
+        print(f"XML parse error in batch starting at {batch[0]}: {e}")
+    return articles, batch
 
-def process_batch(batch):
-    """Process a batch of PMIDs"""
+def split_valid(batch, articles):
+    """Split a batch into articles with abstract and DOI, and failed IDs"""
     results = []
+    failed_ids = []
     for pmid in batch:
-        article_data = fetch_article_data(pmid)
+        article_data = articles.get(pmid)
         if article_data and article_data["abstract"] and article_data["doi"]:
             results.append(article_data)
-    return results, batch
+        else:
+            failed_ids.append(pmid)
+    return results, failed_ids
+
+def format_author(author):
+    """Format an author dict as 'Name (Affiliation)'"""
+    if not author:
+        return None
+    if author['affiliation']:
+        return f"{author['name']} ({author['affiliation']})"
+    return author['name']
 
 def format_article_markdown(data):
     """Format article data as markdown"""
@@ -59,8 +207,8 @@ def format_article_markdown(data):
         f"- **Article ID**: {data['pub_id']}\n",
         f"- **DOI**: {data['doi']}\n",
         f"- **Keywords**: {', '.join(data['keyword'])}\n",
-        f"- **First Author Affiliation**: {data['first_author_affiliation']}\n",
-        f"- **Corresponding Author Affiliation**: {data['communicate_author_affiliation']}\n",
+        f"- **First Author Affiliation**: {format_author(data['first_author_affiliation'])}\n",
+        f"- **Corresponding Author Affiliation**: {format_author(data['communicate_author_affiliation'])}\n",
         f"- **Journal**: {data['journal']}\n",
         f"- **Publication Date**: {data['pub_date']}\n",
         f"**Abstract**: {data['abstract']}\n\n"
@@ -68,12 +216,17 @@ def format_article_markdown(data):
     return ''.join(lines)
 
 def has_github_link(abstract):
-    """Check if abstract contains GitHub link"""
-    return "ithub" in abstract or "avaliable" in abstract
+    """Check if abstract contains a GitHub or other code/data link"""
+    return _LINK_RE.search(abstract) is not None
 
-def md_to_html(md_content):
-    """Convert markdown to HTML with styling"""
-    html_content = markdown.markdown(md_content)
+def render_markdown(md_content):
+    """Convert markdown to an HTML fragment"""
+    if cmarkgfm is not None:
+        return cmarkgfm.github_flavored_markdown_to_html(md_content)
+    return _MARKDOWN_IT.render(md_content)
+
+def wrap_html(html_content):
+    """Wrap an HTML fragment in a styled page"""
     return f"""<!DOCTYPE html>
 <html><head><meta charset="UTF-8">
 <style>
@@ -84,26 +237,70 @@ pre {{ background-color: #f5f5f5; padding: 10px; }}
 </style>
 </head><body>{html_content}</body></html>"""
 
+def write_text(filepath, content):
+    """Write text as UTF-8 in a single buffered write"""
+    with open(filepath, 'wb', buffering=WRITE_BUFFER) as f:
+        f.write(content.encode('utf-8'))
+
 def save_json_lines(filepath, data_list):
     """Save list of dicts as JSON lines"""
-    with open(filepath, 'w', encoding='utf-8') as f:
+    with open(filepath, 'wb', buffering=WRITE_BUFFER) as f:
         for item in data_list:
-            f.write(json.dumps(item, ensure_ascii=False) + '\n')
+            f.write(orjson.dumps(item) + b'\n')
+
+def md_cache_version():
+    """Identify the markdown format and the HTML renderer in use"""
+    return (MD_FORMAT_VERSION, 'cmarkgfm' if cmarkgfm is not None else 'markdown-it')
+
+def load_md_cache(cache_file):
+    """Load (markdown, HTML) pairs keyed by (pub_id, article hash)"""
+    # Any unreadable or foreign cache is simply rebuilt
+    try:
+        with open(cache_file, 'rb') as f:
+            version, entries = pickle.load(f)
+    except Exception:
+        return {}
+    return entries if version == md_cache_version() else {}
+
+def save_md_cache(cache_file, entries):
+    """Save formatted markdown cache"""
+    with open(cache_file, 'wb') as f:
+        pickle.dump((md_cache_version(), entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def article_digest(article):
+    """Hash article data independent of key order"""
+    return hashlib.blake2b(orjson.dumps(article, option=orjson.OPT_SORT_KEYS)).digest()
 
 def generate_outputs(prefix, select_link=True):
     """Generate all output files from JSON data"""
     json_file = f"{prefix}id_information.json"
+    md_cache_file = f"{prefix}md_cache.pkl"
     
-    # Read all data
-    with open(json_file, 'r', encoding='utf-8') as f:
-        articles = [json.loads(line) for line in f if line.strip()]
+    # Read all data, keeping the first record of each PMID
+    articles = []
+    seen = set()
+    with open(json_file, 'rb') as f:
+        for line in f:
+            if line.strip():
+                article = orjson.loads(line)
+                if article['pub_id'] not in seen:
+                    seen.add(article['pub_id'])
+                    articles.append(article)
+    
+    md_cache = load_md_cache(md_cache_file)
+    new_md_cache = {}
     
     # Separate data
     pmcids = []
     no_pmcids = []
     all_md = []
+    all_html = []
     link_articles = []
     no_link_articles = []
+    link_md = []
+    link_html = []
+    no_link_md = []
+    no_link_html = []
     
     for article in articles:
         # Extract PMC IDs
@@ -112,93 +309,134 @@ def generate_outputs(prefix, select_link=True):
         else:
             no_pmcids.append(article)
         
-        # Format markdown
-        md_text = format_article_markdown(article)
+        # Format markdown and HTML once per article, reusing cached output
+        # for unchanged articles
+        key = (article['pub_id'], article_digest(article))
+        cached = md_cache.get(key)
+        if cached is None:
+            md_text = format_article_markdown(article)
+            cached = (md_text, render_markdown(md_text))
+        new_md_cache[key] = cached
+        md_text, html_text = cached
         all_md.append(md_text)
+        all_html.append(html_text)
         
-        # Separate by GitHub link
+        # Separate by GitHub link, reusing the formatted output
         if select_link:
             if has_github_link(article['abstract']):
                 link_articles.append(article)
+                link_md.append(md_text)
+                link_html.append(html_text)
             else:
                 no_link_articles.append(article)
+                no_link_md.append(md_text)
+                no_link_html.append(html_text)
+    
+    save_md_cache(md_cache_file, new_md_cache)
     
     # Save outputs
-    with open("pmcids.txt", 'w', encoding='utf-8') as f:
-        f.write('\n'.join(pmcids))
+    write_text("pmcids.txt", '\n'.join(pmcids))
     
     save_json_lines("no_pmcids.json", no_pmcids)
     
     # Save markdown and HTML
-    md_content = ''.join(all_md)
-    with open(f"{prefix}id_information.md", 'w', encoding='utf-8') as f:
-        f.write(md_content)
-    with open(f"{prefix}id_information.html", 'w', encoding='utf-8') as f:
-        f.write(md_to_html(md_content))
+    write_text(f"{prefix}id_information.md", ''.join(all_md))
+    write_text(f"{prefix}id_information.html", wrap_html(''.join(all_html)))
     
     if select_link:
         # Link articles
         save_json_lines(f"{prefix}link_id_information.json", link_articles)
-        link_md = ''.join([format_article_markdown(a) for a in link_articles])
-        with open(f"{prefix}link_id_information.md", 'w', encoding='utf-8') as f:
-            f.write(link_md)
-        with open(f"{prefix}link_id_information.html", 'w', encoding='utf-8') as f:
-            f.write(md_to_html(link_md))
+        write_text(f"{prefix}link_id_information.md", ''.join(link_md))
+        write_text(f"{prefix}link_id_information.html", wrap_html(''.join(link_html)))
         
         # No link articles
         save_json_lines(f"{prefix}no_link_id_information.json", no_link_articles)
-        no_link_md = ''.join([format_article_markdown(a) for a in no_link_articles])
-        with open(f"{prefix}no_link_id_information.md", 'w', encoding='utf-8') as f:
-            f.write(no_link_md)
-        with open(f"{prefix}no_link_id_information.html", 'w', encoding='utf-8') as f:
-            f.write(md_to_html(no_link_md))
+        write_text(f"{prefix}no_link_id_information.md", ''.join(no_link_md))
+        write_text(f"{prefix}no_link_id_information.html", wrap_html(''.join(no_link_html)))
     
     print(f"Generated output files with {len(articles)} articles")
 
-def process_all_ids(pm_ids, prefix="", select_link=True):
-    """Process all PMIDs with multithreading"""
-    batches = [pm_ids[i:i+BATCH_SIZE] for i in range(0, len(pm_ids), BATCH_SIZE)]
-    failed_ids = []
+def write_results(out, results):
+    """Write article data to an open JSON lines output"""
+    out.write(b''.join(orjson.dumps(result) + b'\n' for result in results))
+
+def process_all_ids(pm_ids, prefix="", select_link=True, api_key=None, email=None, refresh=False):
+    """Process all PMIDs with multithreading, one EFetch request per batch
     
-    # Initialize output file
-    json_file = f"{prefix}id_information.json"
-    with open(json_file, 'w', encoding='utf-8') as f:
-        f.write("")
+    Articles already in the local cache are not fetched again unless
+    refresh is set.
+    """
+    # NCBI allows 10 requests/second with an API key, 3 without
+    rate_limiter = RateLimiter(10 if api_key else 3)
+    cache = open_cache()
+    cached = {} if refresh else load_cached_articles(cache, pm_ids)
+    missing_ids = [pmid for pmid in pm_ids if pmid not in cached]
+    batches = [missing_ids[i:i+BATCH_SIZE] for i in range(0, len(missing_ids), BATCH_SIZE)]
+    if cached:
+        print(f"Loaded {len(cached)} articles from cache")
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = [executor.submit(process_batch, batch) for batch in batches]
+    # Results and failures are only written from this thread, so one handle
+    # each serves all batches; failed IDs are line-buffered to survive crashes
+    json_file = f"{prefix}id_information.json"
+    failed_count = 0
+    with open(json_file, 'wb', buffering=WRITE_BUFFER) as out, \
+            open("failed_ids.txt", 'w', buffering=1) as fail_f, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results, failed_ids = split_valid(list(cached), cached)
+        write_results(out, results)
+        fail_f.writelines(pmid + '\n' for pmid in failed_ids)
+        failed_count += len(failed_ids)
         
+        # Workers fetch while this thread writes; keep a bounded window of
+        # batches in flight so finished results never pile up in memory
+        batch_iter = iter(batches)
+        pending = set()
         with tqdm(total=len(batches), desc="Processing") as pbar:
-            for future in as_completed(futures):
-                results, current_batch = future.result()
-                if results:
-                    # Write successful results
-                    with open(json_file, "a", encoding="utf-8") as f:
-                        for result in results:
-                            f.write(json.dumps(result, ensure_ascii=False) + '\n')
-                else:
-                    failed_ids.extend(current_batch)
-                pbar.update(1)
+            while True:
+                for batch in batch_iter:
+                    pending.add(executor.submit(process_batch, batch, rate_limiter, api_key, email))
+                    if len(pending) >= MAX_PENDING:
+                        break
+                if not pending:
+                    break
+                
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    articles, batch = future.result()
+                    save_cached_articles(cache, articles)
+                    results, failed_ids = split_valid(batch, articles)
+                    if results:
+                        # Write successful results
+                        write_results(out, results)
+                    fail_f.writelines(pmid + '\n' for pmid in failed_ids)
+                    failed_count += len(failed_ids)
+                    pbar.update(1)
+    cache.close()
+    
+    if failed_count:
+        print(f"Saved {failed_count} failed IDs to failed_ids.txt")
     
     # Generate all output files
     try:
         generate_outputs(prefix, select_link)
     except Exception as e:
         print(f"Error generating output files: {e}")
-        return
-    
-    # Save failed IDs
-    if failed_ids:
-        with open("failed_ids.txt", "w") as f:
-            f.write("\n".join(failed_ids))
-        print(f"Saved {len(failed_ids)} failed IDs to failed_ids.txt")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract article information for PubMed IDs")
+    parser.add_argument("--refresh", action="store_true", help="ignore the article cache and refetch all IDs")
+    args = parser.parse_args()
+    
     input_file = BASE_DIR / "pubmed_ids.txt"
+    config = load_config(BASE_DIR / "search_config.json") or {}
+    api_key = config.get('NCBI_api', '').strip()
+    if api_key.lower() in ['', 'your_api_key_here_optional', 'optional']:
+        api_key = None
+    email = config.get('email') or None
     
     with open(input_file) as f:
         pm_ids = [line.strip() for line in f if line.strip()]
     
     print(f"Processing {len(pm_ids)} articles...")
-    process_all_ids(pm_ids, prefix="", select_link=True)
+    process_all_ids(pm_ids, prefix="", select_link=True, api_key=api_key, email=email, refresh=args.refresh)
     print("Done!")